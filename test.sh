@@ -23,6 +23,46 @@ for f in test-input/.*.y*ml test-input/*.y*ml; do
   fi
 done
 
+echo "== test --dedup"
+f=test-input/.gitlab-ci-duplicates.yml
+python3 yaml_shellcheck.py --dedup "$f" 2>&1 \
+  | grep -o '\bSC[0-9]*\b' \
+  > "$f.test_findings_dedup"
+if diff "$f.test_expected_dedup" "$f.test_findings_dedup"; then
+  echo "OK"
+else
+  echo "ERROR"
+  touch found_error
+fi
+
+echo "== test --no-cache with a warm cache"
+XDG_CACHE_HOME=$(mktemp -d)
+export XDG_CACHE_HOME
+python3 yaml_shellcheck.py test-input/.*.y*ml test-input/*.y*ml > /dev/null 2>&1
+python3 yaml_shellcheck.py test-input/.*.y*ml test-input/*.y*ml > test_cached.txt 2> /dev/null
+python3 yaml_shellcheck.py --no-cache test-input/.*.y*ml test-input/*.y*ml > test_uncached.txt 2> /dev/null
+if diff test_uncached.txt test_cached.txt; then
+  echo "OK"
+else
+  echo "ERROR"
+  touch found_error
+fi
+rm -rf "$XDG_CACHE_HOME" test_cached.txt test_uncached.txt
+unset XDG_CACHE_HOME
+
+echo "== test -j 1 and -j 4"
+python3 yaml_shellcheck.py --no-cache -j 1 -c "shellcheck -f gcc" \
+  test-input/.*.y*ml test-input/*.y*ml > test_jobs1.txt 2> /dev/null
+python3 yaml_shellcheck.py --no-cache -j 4 -c "shellcheck -f gcc" \
+  test-input/.*.y*ml test-input/*.y*ml > test_jobs4.txt 2> /dev/null
+if diff test_jobs1.txt test_jobs4.txt; then
+  echo "OK"
+else
+  echo "ERROR"
+  touch found_error
+fi
+rm -f test_jobs1.txt test_jobs4.txt
+
 # fail test job on error
 if [ -f found_error ]; then
   exit 1
@@ -6,7 +6,14 @@
 # Copyright (c) 2021, Martin Schütte <info@mschuette.name>
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
+import itertools
+import json
 import logging
+import os
+import shlex
 import shutil
 import subprocess
 import tempfile
@@ -14,14 +21,41 @@ from pathlib import Path
 import re
 import sys
 
-from ruamel.yaml import YAML
-from ruamel.yaml.nodes import ScalarNode
+logger = logging.getLogger(__name__)
 
-global logger
+# shellcheck output formats that can be concatenated from several processes
+_CONCAT_FORMATS = ("gcc", "quiet")
+# starting shellcheck is not free, so every process should get some files
+_MIN_FILES_PER_PROCESS = 8
+
+# YAML mapping and sequence types built by the safe loader
+_CONTAINER_TYPES = frozenset((dict, list))
+
+# Bitbucket step settings that never contain nested scripts
+_BITBUCKET_STEP_LEAF_KEYS = frozenset(
+    ("artifacts", "caches", "image", "services", "trigger", "name")
+)
+
+# os.writev() is not available on Windows
+_HAVE_WRITEV = hasattr(os, "writev")
+
+# GitLab CI job attributes containing shell scripts
+_GITLAB_SCRIPT_SECTIONS = ("script", "before_script", "after_script")
+
+# Ansible module names for shell tasks, simple and qualified collection names
+_ANSIBLE_SHELL_KEYS = ("shell", "ansible.builtin.shell")
+
+# GitHub Actions context expressions '${{ foo }}'
+_GHA_EXPR_RE = re.compile(r"\$\{\{.*?\}\}")
+# CircleCI pipeline parameters '<< foo >>'
+_CIRCLE_PARAM_RE = re.compile(r"<<\s*([^\s>]*)\s*>>")
+# GitLab CI inputs interpolation '$[[ inputs.foo ]]'
+_GITLAB_INPUT_RE = re.compile(r"\$\[\[\s*(inputs\.[^]]*)\s*]]")
+# Ansible Jinja expressions '{{ foo }}'
+_JINJA_EXPR_RE = re.compile(r"\{\{.*?\}\}")
 
 
 def setup():
-    global logger
     parser = argparse.ArgumentParser(
         description="run shellcheck on script blocks from .gitlab-ci.yml or bitbucket-pipelines.yml",
     )
@@ -39,6 +73,22 @@ def setup():
         action="store_true",
     )
     parser.add_argument("-d", "--debug", help="debug output", action="store_true")
+    parser.add_argument(
+        "--no-cache",
+        help="do not read or write the cache of previously parsed files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dedup",
+        help="check identical scripts only once, findings are reported for the first job",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="maximum number of parallel processes, to parse files and to run shellcheck (default: number of CPUs)",
+        type=int,
+    )
     parser.add_argument(
         "-s",
         "--shell",
@@ -54,20 +104,77 @@ def setup():
         type=str,
     )
     args = parser.parse_args()
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("argument -j/--jobs: must be at least 1")
+    # split the shellcheck command once, with shell-like quoting;
+    # not in Windows paths, where a backslash is no escape character
+    try:
+        args.command_argv = shlex.split(args.command, posix=os.name != "nt")
+    except ValueError as e:
+        parser.error(f"argument -c/--command: {e}")
+    if not args.command_argv:
+        parser.error("argument -c/--command: must not be empty")
+
+    setup_logging(args.debug)
 
-    # Enable logging
+    if not args.outdir:
+        # the files are written and read only once, so prefer a tmpfs,
+        # unless the user has chosen a tmp dir with one of the variables tempfile reads
+        tmp_dir = None
+        user_tmp_dir = any(os.environ.get(name) for name in ("TMPDIR", "TEMP", "TMP"))
+        if not user_tmp_dir and os.access("/dev/shm", os.W_OK | os.X_OK):
+            tmp_dir = "/dev/shm"
+        args.outdir = tempfile.mkdtemp(prefix="py_yaml_shellcheck_", dir=tmp_dir)
+        logger.debug("created working dir: %s", args.outdir)
+    else:
+        os.makedirs(args.outdir, exist_ok=True)
+    return args
+
+
+def setup_logging(debug):
+    """Enable logging, also used as initializer for the worker processes"""
     console_handler = logging.StreamHandler()
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=logging.DEBUG if args.debug else logging.INFO,
+        level=logging.DEBUG if debug else logging.INFO,
         handlers=[console_handler],
     )
-    logger = logging.getLogger(__name__)
 
-    if not args.outdir:
-        args.outdir = tempfile.mkdtemp(prefix="py_yaml_shellcheck_")
-        logger.debug("created working dir: %s", args.outdir)
-    return args
+
+def log_scripts(result):
+    # skip the loop over all scripts unless we really log them
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("got scripts: %s", result)
+    for key in result:
+        logger.debug("%s: %s", key, result[key])
+
+
+def flatten_nested_string_lists(data, skip_key=None):
+    """join a script given as string or (nested) list of strings,
+    collects all strings and joins them once;
+    mappings with skip_key are no shell commands and left out"""
+    if type(data) is str:
+        # the common case, nothing to join
+        return data
+    lines = []
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            lines.append(item)
+        elif isinstance(item, list):
+            if not item:
+                # an empty list still contributes an empty line
+                lines.append("")
+            stack.extend(reversed(item))
+        elif skip_key is not None and isinstance(item, dict) and skip_key in item:
+            logger.debug("skipping %s in script section: %s", skip_key, item[skip_key])
+        else:
+            raise ValueError(
+                f"unexpected data type {type(item)} in script section: {item}"
+            )
+    return "\n".join(lines)
 
 
 def get_bitbucket_scripts(data):
@@ -75,95 +182,88 @@ def get_bitbucket_scripts(data):
     publish a schema, as a result we simply search all scripts elements,
     something like `pipelines.**.script`
     """
-    logging.debug("get_bitbucket_scripts()")
+    logger.debug("get_bitbucket_scripts()")
 
     def get_scripts(data, path):
+        # iterative depth-first walk, children are pushed in reverse
+        # so that scripts are still found in document order;
+        # path is a tuple of keys and only joined for found scripts;
+        # scalars cannot contain scripts, so only dicts and lists are pushed
+        # the safe loader only builds plain dicts and lists, so exact type
+        # checks are enough and cheaper than isinstance()
         results = {}
-        if isinstance(data, dict):
-            if "script" in data:
-                script = data["script"]
-                if isinstance(script, str):
-                    results[f"{path}/script"] = script
-                elif isinstance(script, list):
-                    results[f"{path}/script"] = "\n".join(script)
-            for key in data:
-                results.update(get_scripts(data[key], f"{path}/{key}"))
-        elif isinstance(data, list):
-            for i, item in enumerate(data):
-                results.update(get_scripts(item, f"{path}/{i}"))
-        elif (
-            isinstance(data, str)
-            or isinstance(data, int)
-            or isinstance(data, float)
-            or data is None
-        ):
-            pass
+        stack = [(data, path)] if type(data) in _CONTAINER_TYPES else []
+        while stack:
+            data, path = stack.pop()
+            if type(data) is dict:
+                script = data.get("script")
+                if isinstance(script, (str, list)):
+                    results["/".join(path + ("script",))] = flatten_nested_string_lists(
+                        script, skip_key="pipe"
+                    )
+                    # this is a step, its settings cannot contain other steps
+                    skip_keys = _BITBUCKET_STEP_LEAF_KEYS
+                else:
+                    skip_keys = ()
+                for key, value in reversed(data.items()):
+                    if key == "script" or key in skip_keys:
+                        # script already handled, step settings are pruned
+                        continue
+                    if type(value) in _CONTAINER_TYPES:
+                        stack.append((value, path + (str(key),)))
+            else:
+                for i in range(len(data) - 1, -1, -1):
+                    if type(data[i]) in _CONTAINER_TYPES:
+                        stack.append((data[i], path + (str(i),)))
         return results
 
     result = {}
     if "pipelines" not in data:
         return result
-    result = get_scripts(data["pipelines"], "pipelines")
-    logging.debug("got scripts: %s", result)
-    for key in result:
-        logging.debug("%s: %s", key, result[key])
+    result = get_scripts(data["pipelines"], ("pipelines",))
+    log_scripts(result)
     return result
 
 
 def get_github_scripts(data):
-    """GitHub Workflows: from the docs the search pattern should be `jobs.<job_id>.steps[*].run`
+    """GitHub Workflows: from the docs the search pattern is `jobs.<job_id>.steps[*].run`
     https://docs.github.com/en/actions/reference/workflow-syntax-for-github-actions
 
-    as a simple first step we match on `jobs.**.run`, excluding `jobs.**.defaults.run`
-
     and,
     GitHub Actions: match on runs.steps[*].run
+
+    the schema is fixed, so we only look at the steps and not at jobs.<job_id>.defaults.run,
+    matrix values, etc.
     """
 
-    def get_runs(data, path):
+    def get_runs(steps, path):
         results = {}
-        if isinstance(data, dict):
-            if "run" in data and isinstance(data["run"], str):
-                script = data["run"]
-                if not isinstance(script, str):
-                    raise ValueError(
-                        "unexpected format of 'run' element, expected string and found "
-                        + str(type(script))
-                    )
+        for step_num, step in enumerate(steps or []):
+            if not isinstance(step, dict):
+                continue
+            script = step.get("run")
+            if not isinstance(script, str):
+                continue
 
-                # GitHub Actions uses '${{ foo }}' for context expressions,
-                # we try to be useful and replace these with a simple shell variable
-                script = re.sub(r"\${{.*}}", "$ACTION_EXPRESSION", script)
-
-                results[f"{path}/run"] = script
-
-            for key in data:
-                if key == "defaults":
-                    # GitHub Actions has jobs.<job_id>.defaults.run which we don't want to match on.
-                    continue
-                results.update(get_runs(data[key], f"{path}/{key}"))
-        elif isinstance(data, list):
-            for i, item in enumerate(data):
-                results.update(get_runs(item, f"{path}/{i}"))
-        elif (
-            isinstance(data, str)
-            or isinstance(data, int)
-            or isinstance(data, float)
-            or data is None
-        ):
-            pass
+            # GitHub Actions uses '${{ foo }}' for context expressions,
+            # we try to be useful and replace these with a simple shell variable
+            if "${{" in script:
+                script = _GHA_EXPR_RE.sub("$ACTION_EXPRESSION", script)
+
+            results[f"{path}/steps/{step_num}/run"] = script
         return results
 
     result = {}
     if "jobs" in data:  # workflow
-        result = get_runs(data["jobs"], "jobs")
+        for jobkey, job in (data["jobs"] or {}).items():
+            if isinstance(job, dict):
+                result.update(get_runs(job.get("steps"), f"jobs/{jobkey}"))
     elif "runs" in data:  # actions
-        result = get_runs(data["runs"], "runs")
+        if isinstance(data["runs"], dict):
+            result = get_runs(data["runs"].get("steps"), "runs")
     else:  # neither
         return result
-    logging.debug("got scripts: %s", result)
-    for key in result:
-        logging.debug("%s: %s", key, result[key])
+    log_scripts(result)
     return result
 
 
@@ -175,16 +275,18 @@ def get_circleci_scripts(data):
     result = {}
     if "jobs" not in data:
         return result
-    for jobkey, job in data["jobs"].items():
-        steps = job.get("steps", [])
-        logging.debug("job %s: %s", jobkey, steps)
+    for jobkey, job in (data["jobs"] or {}).items():
+        if not isinstance(job, dict):
+            continue
+        steps = job.get("steps") or []
+        logger.debug("job %s: %s", jobkey, steps)
         for step_num, step in enumerate(steps):
             if not (isinstance(step, dict) and "run" in step):
-                logging.debug("job %s, step %d: no run declaration", jobkey, step_num)
+                logger.debug("job %s, step %d: no run declaration", jobkey, step_num)
                 continue
             run = step["run"]
             shell = None
-            logging.debug("job %s, step %d: found %s %s", jobkey, step_num, type(run), run)
+            logger.debug("job %s, step %d: found %s %s", jobkey, step_num, type(run), run)
             # challenge: the run element can have different data types
             if isinstance(run, dict):
                 if "command" in run:
@@ -193,7 +295,7 @@ def get_circleci_scripts(data):
                         shell = run["shell"]
                 else:
                     # this step could be a directive like `save_cache`
-                    logging.info("job %s, step %d: no 'command' attribute", jobkey, step_num)
+                    logger.info("job %s, step %d: no 'command' attribute", jobkey, step_num)
                     script = ""
             elif isinstance(run, str):
                 script = run
@@ -204,7 +306,8 @@ def get_circleci_scripts(data):
 
             # CircleCI uses '<< foo >>' for context parameters,
             # we try to be useful and replace these with a simple shell variable
-            script = re.sub(r'<<\s*([^\s>]*)\s*>>', r'"$PARAMETER"', script)
+            if "<<" in script:
+                script = _CIRCLE_PARAM_RE.sub(r'"$PARAMETER"', script)
             # add shebang line if we saw a 'shell' attribute
             # TODO: we do not check for supported shell like we do in get_ansible_scripts
             # TODO: not sure what is the best handling of bash vs. sh as default here
@@ -212,12 +315,10 @@ def get_circleci_scripts(data):
                 # CircleCI default shell, see doc "Default shell options"
                 shell = "/bin/bash"
 
-            script = f"#!{shell}\n" + script
+            script = f"#!{shell}\n{script}"
             result[f"{jobkey}/{step_num}"] = script
 
-    logging.debug("got scripts: %s", result)
-    for key in result:
-        logging.debug("%s: %s", key, result[key])
+    log_scripts(result)
     return result
 
 
@@ -229,12 +330,10 @@ def get_drone_scripts(data):
     if "steps" not in data:
         return result
     jobkey = data.get("name", "unknown")
-    for item in data["steps"]:
+    for item in data["steps"] or []:
         section = item.get("name")
-        result[f"{jobkey}/{section}"] = "\n".join(item.get("commands", []))
-    logging.debug("got scripts: %s", result)
-    for key in result:
-        logging.debug("%s: %s", key, result[key])
+        result[f"{jobkey}/{section}"] = "\n".join(item.get("commands") or [])
+    log_scripts(result)
     return result
 
 
@@ -242,28 +341,19 @@ def get_gitlab_scripts(data):
     """GitLab is nice, as far as I can tell its files have a
     flat hierarchy with many small job entities"""
 
-    def flatten_nested_string_lists(data):
-        """helper function"""
-        if isinstance(data, str):
-            return data
-        elif isinstance(data, list):
-            return "\n".join([flatten_nested_string_lists(item) for item in data])
-        else:
-            raise ValueError(
-                f"unexpected data type {type(data)} in script section: {data}"
-            )
-
     result = {}
-    for jobkey in data:
-        if not isinstance(data[jobkey], dict):
+    for jobkey, job in data.items():
+        if type(job) is not dict:
             continue
-        for section in ["script", "before_script", "after_script"]:
-            if section in data[jobkey]:
-                script = data[jobkey][section]
-                script = flatten_nested_string_lists(script)
-                # replace inputs interpolation with dummy variable
-                script = re.sub(r'\$\[\[\s*(inputs\.[^]]*)\s*]]', r'$INPUT_PARAMETER', script)
-                result[f"{jobkey}/{section}"] = flatten_nested_string_lists(script)
+        for section in _GITLAB_SCRIPT_SECTIONS:
+            script = job.get(section)
+            if script is None:
+                continue
+            script = flatten_nested_string_lists(script)
+            # replace inputs interpolation with dummy variable
+            if "$[[" in script:
+                script = _GITLAB_INPUT_RE.sub("$INPUT_PARAMETER", script)
+            result[f"{jobkey}/{section}"] = script
     return result
 
 
@@ -273,39 +363,54 @@ def get_ansible_scripts(data):
     """
 
     def get_shell_tasks(data, path):
+        # iterative walk over the nested task lists, the stack holds one
+        # iterator per open task list, so results stay in document order
         results = {}
-        for i, task in enumerate(data):
-            # look for simple and qualified collection names:
-            for key in ["shell", "ansible.builtin.shell"]:
-                if key in task:
-                    # may be a string or a dict
-                    if isinstance(task[key], str):
-                        script = task[key]
-                    elif isinstance(task[key], dict) and "cmd" in task[key]:
-                        script = task[key]["cmd"]
-                    else:
-                        raise ValueError(f"unexpected data in element {path}/{i}/{key}")
-
-                    # we cannot evaluate Jinja templates
-                    # at least try to be useful and replace every expression with a variable
-                    # we do not handle Jinja statements like loops of if/then/else
-                    script = re.sub(r"{{.*?}}", "$JINJA_EXPRESSION", script)
-
-                    # try to add shebang line from 'executable' if it looks like a shell
-                    executable = task.get("args", {}).get("executable", None)
-                    if executable and "sh" not in executable:
-                        logging.debug(
-                            f"unsupported shell %s, in %d/%s", executable, i, key
-                        )
-                        # ignore this task
-                        continue
-                    elif executable:
-                        script = f"#!{executable}\n" + script
-                    results[f"{path}/{i}/{key}"] = script
-            if "tasks" in task:
-                results.update(get_shell_tasks(task["tasks"], f"{path}/{i}"))
-            if "block" in task:
-                results.update(get_shell_tasks(task["block"], f"{path}/block-{i}"))
+        stack = [(enumerate(data), path)]
+        while stack:
+            tasks, path = stack[-1]
+            for i, task in tasks:
+                # look for simple and qualified collection names:
+                for key in _ANSIBLE_SHELL_KEYS:
+                    if key in task:
+                        # may be a string or a dict
+                        if isinstance(task[key], str):
+                            script = task[key]
+                        elif isinstance(task[key], dict) and "cmd" in task[key]:
+                            script = task[key]["cmd"]
+                        else:
+                            raise ValueError(f"unexpected data in element {path}/{i}/{key}")
+
+                        # we cannot evaluate Jinja templates
+                        # at least try to be useful and replace every expression with a variable
+                        # we do not handle Jinja statements like loops of if/then/else
+                        if "{{" in script:
+                            script = _JINJA_EXPR_RE.sub("$JINJA_EXPRESSION", script)
+
+                        # try to add shebang line from 'executable' if it looks like a shell
+                        executable = (task.get("args") or {}).get("executable")
+                        if executable and "sh" not in executable:
+                            logger.debug(
+                                f"unsupported shell %s, in %d/%s", executable, i, key
+                            )
+                            # ignore this task
+                            continue
+                        elif executable:
+                            script = f"#!{executable}\n{script}"
+                        results[f"{path}/{i}/{key}"] = script
+                # continue with nested task lists before the next task,
+                # pushed in reverse to read `tasks` before `block`
+                nested = []
+                if "block" in task:
+                    nested.append((enumerate(task["block"] or []), f"{path}/block-{i}"))
+                if "tasks" in task:
+                    nested.append((enumerate(task["tasks"] or []), f"{path}/{i}"))
+                if nested:
+                    stack.extend(nested)
+                    break
+            else:
+                # task list done
+                stack.pop()
         return results
 
     result = {}
@@ -314,9 +419,7 @@ def get_ansible_scripts(data):
     else:
         return result
 
-    logging.debug("got scripts: %s", result)
-    for key in result:
-        logging.debug("%s: %s", key, result[key])
+    log_scripts(result)
     return result
 
 
@@ -330,125 +433,393 @@ def select_yaml_schema(documents, filename):
     # special case first: GitLab 17 adds an optional spec-document before the main content document
     # https://docs.gitlab.com/ee/ci/yaml/inputs.html
     if len(documents) == 2 and "spec" in documents[0]:
-        logging.info(f"read {filename} as GitLab CI config with spec header section ...")
+        logger.info(f"read {filename} as GitLab CI config with spec header section ...")
         return get_gitlab_scripts, 1
 
     # in previous versions we ignored additional documents in YAML files
     if len(documents) > 1:
-        logging.warning(f"{filename} contains multiple YAML, only the first will be checked")
+        logger.warning(f"{filename} contains multiple YAML, only the first will be checked")
 
     # else: documents == 1; all other tools and cases only read a single YAML document
     data = documents[0]
-    if isinstance(data, dict) and "pipelines" in data:
-        logging.info(f"read {filename} as Bitbucket Pipelines config...")
+    if isinstance(data, list):
+        logger.info(f"read {filename} as Ansible file...")
+        return get_ansible_scripts, 0
+    if not isinstance(data, dict):
+        raise ValueError(f"read {filename}, cannot determine CI tool from YAML structure")
+
+    keys = data.keys()
+    if "pipelines" in keys:
+        logger.info(f"read {filename} as Bitbucket Pipelines config...")
         return get_bitbucket_scripts, 0
-    elif isinstance(data, dict) and "on" in data and "jobs" in data:
-        logging.info(f"read {filename} as GitHub Workflows config...")
+    if "on" in keys and "jobs" in keys:
+        logger.info(f"read {filename} as GitHub Workflows config...")
         return get_github_scripts, 0
-    elif isinstance(data, dict) and "inputs" in data and "runs" in data:
-        logging.info(f"read {filename} as GitHub Actions config...")
+    if "inputs" in keys and "runs" in keys:
+        logger.info(f"read {filename} as GitHub Actions config...")
         return get_github_scripts, 0
-    elif isinstance(data, dict) and "version" in data and "jobs" in data:
-        logging.info(f"read {filename} as CircleCI config...")
+    if "version" in keys and "jobs" in keys:
+        logger.info(f"read {filename} as CircleCI config...")
         return get_circleci_scripts, 0
-    elif (
-        isinstance(data, dict) and "steps" in data and "kind" in data and "type" in data
-    ):
-        logging.info(f"read {filename} as Drone CI config...")
+    if "steps" in keys and "kind" in keys and "type" in keys:
+        logger.info(f"read {filename} as Drone CI config...")
         return get_drone_scripts, 0
-    elif isinstance(data, list):
-        logging.info(f"read {filename} as Ansible file...")
-        return get_ansible_scripts, 0
-    elif isinstance(data, dict):
-        # TODO: GitLab is the de facto default value, we should add more checks here
-        logging.info(f"read {filename} as GitLab CI config...")
-        return get_gitlab_scripts, 0
-    else:
-        raise ValueError(f"read {filename}, cannot determine CI tool from YAML structure")
+    # TODO: GitLab is the de facto default value, we should add more checks here
+    logger.info(f"read {filename} as GitLab CI config...")
+    return get_gitlab_scripts, 0
+
+
+# the YAML loader and its base exception, created on first use
+_YAML = None
+_YAMLError = None
+
+
+def get_yaml_loader():
+    """one loader for all files in a process;
+    ruamel.yaml is only imported when a file has to be parsed,
+    so runs with only cached files start faster"""
+    global _YAML, _YAMLError
+    if _YAML is None:
+        from ruamel.yaml import YAML
+        from ruamel.yaml.constructor import SafeConstructor
+        from ruamel.yaml.error import YAMLError
+        from ruamel.yaml.nodes import ScalarNode
+
+        class GitLabConstructor(SafeConstructor):
+            """safe constructor with GitLab tags,
+            without changing ruamel's own SafeConstructor"""
+
+            def construct_gitlab_reference(self, node):
+                """GitLab `!reference [job, section]` tags cannot be resolved here,
+                so they are read as a comment line with the same content"""
+                if not all(isinstance(element, ScalarNode) for element in node.value):
+                    raise ValueError(
+                        "Tag !reference only support a sequence of ScalarNode "
+                        f"(should all be strings), but found "
+                        f"{[type(element) for element in node.value]}")
+                return f"# !reference[{', '.join(element.value for element in node.value)}]"
+
+        GitLabConstructor.add_constructor(
+            "!reference", GitLabConstructor.construct_gitlab_reference
+        )
+
+        _YAML = YAML(typ="safe")
+        _YAML.Constructor = GitLabConstructor
+        _YAMLError = YAMLError
+    return _YAML
 
 
 def read_yaml_file(filename):
     """read YAML and return dict with job name and shell scripts"""
-    global logger
 
-    class GitLabReference(object):
-        yaml_tag = "!reference"
+    # libyaml reads and decodes the raw bytes itself
+    # select_yaml_schema() never needs more than three documents,
+    # stop parsing after those and release the parser
+    yaml = get_yaml_loader()
+    try:
+        with open(filename, "rb") as f, contextlib.closing(yaml.load_all(f)) as documents:
+            yaml_documents = list(itertools.islice(documents, 3))
+    except _YAMLError as e:
+        # a syntax error only skips this file, the message contains the file name
+        raise ValueError(str(e)) from None
+    get_script_snippets, document_index = select_yaml_schema(yaml_documents, filename)
+    return get_script_snippets(yaml_documents[document_index])
 
-        def __init__(self, elements: list[str]):
-            self.elements = elements
 
-        def __str__(self):
-            return f"# {self.yaml_tag}[{', '.join(self.elements)}]"
+class MessageCollector(logging.Handler):
+    """collects the messages logged while a file is parsed"""
 
-        @classmethod
-        def to_yaml(cls, representer, node):
-            return representer.represent_scalar(
-                cls.yaml_tag, f"[{', '.join(node.value)}]"
-            )
+    def __init__(self):
+        super().__init__(level=logging.INFO)
+        self.messages = []
 
-        @classmethod
-        def from_yaml(cls, constructor, node):
-            if not all(isinstance(element, ScalarNode) for element in node.value):
-                raise ValueError(
-                    f"Tag {cls.yaml_tag} only support a sequence of ScalarNode "
-                    f"(should all be strings), but found "
-                    f"{[type(element) for element in node.value]}")
-            # we instantiate a GitLabReference with cls, but return its string representation
-            return str(cls([element.value for element in node.value]))
-
-    yaml = YAML(typ="safe")
-    yaml.register_class(GitLabReference)
-
-    with open(filename, "r") as f:
-        yaml_documents = list(yaml.load_all(f))
-    get_script_snippets, document_index = select_yaml_schema(yaml_documents, filename)
-    return get_script_snippets(yaml_documents[document_index])
+    def emit(self, record):
+        self.messages.append([record.levelno, record.getMessage()])
+
+
+def parse_yaml_file(filename):
+    """read_yaml_file(), also returns its log messages,
+    so they can be repeated when the scripts are later read from the cache"""
+    collector = MessageCollector()
+    logger.addHandler(collector)
+    try:
+        scripts = read_yaml_file(filename)
+    finally:
+        logger.removeHandler(collector)
+    return scripts, collector.messages
+
+
+def get_cache_dir():
+    """the parse cache follows the XDG base directory spec,
+    returns None if there is no home directory to put it in"""
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        try:
+            cache_home = Path.home() / ".cache"
+        except (RuntimeError, KeyError) as e:
+            # e.g. a container running with an arbitrary uid
+            logger.debug("no home directory, running without cache: %s", e)
+            return None
+    return Path(cache_home, "yaml-shellcheck")
+
+
+def file_fingerprint(filename):
+    st = os.stat(filename)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def get_cache_file(cache_dir, filename):
+    """every input file has its own cache entry, so concurrent runs
+    on different files do not overwrite each other's results"""
+    key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    return cache_dir / f"{key}.json"
+
+
+def get_cached_scripts(cache_dir, tool, filename):
+    """returns the file fingerprint, the cached scripts or None,
+    and the messages logged when the file was parsed;
+    entries are ignored when this tool itself has changed"""
+    try:
+        fingerprint = file_fingerprint(filename)
+    except OSError:
+        # let read_yaml_file() report the error
+        return None, None, []
+    try:
+        with open(get_cache_file(cache_dir, filename), "r") as f:
+            entry = json.load(f)
+        if (
+            entry["tool"] == tool
+            and entry["file"] == os.path.abspath(filename)
+            and entry["fingerprint"] == fingerprint
+            and isinstance(entry["scripts"], dict)
+            and isinstance(entry["messages"], list)
+        ):
+            return fingerprint, entry["scripts"], entry["messages"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return fingerprint, None, []
+
+
+def save_cached_scripts(cache_dir, tool, filename, fingerprint, scripts, messages):
+    cache_file = get_cache_file(cache_dir, filename)
+    # write to a tmp file first, so concurrent runs never read a partial entry
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    entry = {
+        "tool": tool,
+        "file": os.path.abspath(filename),
+        "fingerprint": fingerprint,
+        "scripts": scripts,
+        "messages": messages,
+    }
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(tmp_file, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.debug("cannot write cache %s: %s", cache_file, e)
+
+
+def tmp_subdir(filename):
+    """map an input filename to a relative path inside the output directory"""
+    path = os.path.splitdrive(filename)[1]
+    if os.altsep:
+        path = path.replace(os.altsep, os.sep)
+    # remove all '..' elements from the tmp file paths
+    parts = [part for part in path.split(os.sep) if part not in ("", ".", "..")]
+    if os.path.isabs(filename):
+        # workaround for absolute path in filename, insert path component to avoid collisions
+        parts.insert(0, "__root__")
+    return os.sep.join(parts)
+
+
+def write_tmp_file(path, buffers):
+    """write the buffers to a new file, usually with a single syscall"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        written = os.writev(fd, buffers) if _HAVE_WRITEV else 0
+        if written < sum(len(buffer) for buffer in buffers):
+            # a short write, e.g. on a full disk: write the rest, until it
+            # is done or os.write() raises the error
+            remaining = memoryview(b"".join(buffers))[written:]
+            while remaining:
+                remaining = remaining[os.write(fd, remaining):]
+    finally:
+        os.close(fd)
 
 
 def write_tmp_files(args, data):
     filelist = []
-    outdir = Path(args.outdir)
-    outdir.mkdir(exist_ok=True, parents=True)
+    # plain string paths, joining Path objects is comparatively slow
+    outdir = args.outdir
+    created_dirs = set()
+    # default shebang line, encoded once for all files
+    shebang = f"{args.shell}\n".encode()
+    # script text -> first file written with it, for --dedup
+    seen = {}
     for filename in data:
-        # workaround for absolute path in filename, insert path component to avoid collisions
-        if filename[0] == '/':
-            subdir = outdir / "__root__" / filename[1:]
-        else:
-            subdir = outdir / filename
-        # remove all '..' elements from the tmp file paths
-        if ".." in subdir.parts:
-            parts = filter(lambda a: a != "..", list(subdir.parts))
-            subdir = Path(*parts)
-        subdir.mkdir(exist_ok=True, parents=True)
-        for jobkey in data[filename]:
-            scriptfilename = subdir / jobkey
-            scriptfilename.parent.mkdir(exist_ok=True, parents=True)
-            with open(scriptfilename, "w") as f:
-                if not data[filename][jobkey].startswith("#!"):
-                    f.write(f"{args.shell}\n")
-                f.write(data[filename][jobkey])
-                rel_filename = str(scriptfilename.relative_to(outdir))
-                filelist.append(rel_filename)
+        subdir = tmp_subdir(filename)
+        # the files and scripts of this input file, only used if all can be written
+        file_filelist = []
+        file_seen = {}
+        try:
+            for jobkey, script in data[filename].items():
+                # path relative to outdir, this is also passed to shellcheck
+                rel_filename = os.path.join(subdir, jobkey)
+                if args.dedup:
+                    # the first job with a script is checked, identical ones are skipped
+                    first = seen.get(script) or file_seen.get(script)
+                    if first:
+                        logger.debug("skip %s, same script as %s", rel_filename, first)
+                        continue
+                    file_seen[script] = rel_filename
+                # create every directory once, instead of once per script
+                parent = os.path.dirname(rel_filename)
+                if parent not in created_dirs:
+                    if os.path.dirname(parent) in created_dirs:
+                        # one mkdir, without the existence checks of os.makedirs()
+                        with contextlib.suppress(FileExistsError):
+                            os.mkdir(os.path.join(outdir, parent))
+                        created_dirs.add(parent)
+                    else:
+                        os.makedirs(os.path.join(outdir, parent), exist_ok=True)
+                        # remember the intermediate directories as well
+                        while parent and parent not in created_dirs:
+                            created_dirs.add(parent)
+                            parent = os.path.dirname(parent)
+                if script.startswith("#!"):
+                    buffers = [script.encode()]
+                else:
+                    buffers = [shebang, script.encode()]
+                write_tmp_file(os.path.join(outdir, rel_filename), buffers)
+                file_filelist.append(rel_filename)
                 logger.debug("wrote file %s", rel_filename)
+        except ValueError as e:
+            # e.g. a null byte in a job name; only log, then ignore this input file
+            logger.error("%s: %s", filename, e)
+            continue
+        filelist.extend(file_filelist)
+        seen.update(file_seen)
     return filelist
 
 
-def run_shellcheck(args, filenames):
-    if not filenames:
-        return
-    shellcheck_command = args.command.split() + filenames
+def get_output_format(shellcheck_command):
+    """find the -f/--format option in the shellcheck command, default is tty"""
+    output_format = "tty"
+    for i, arg in enumerate(shellcheck_command):
+        if arg in ("-f", "--format") and i + 1 < len(shellcheck_command):
+            output_format = shellcheck_command[i + 1]
+        elif arg.startswith("--format="):
+            output_format = arg[len("--format="):]
+        elif arg.startswith("-f") and len(arg) > 2:
+            output_format = arg[2:]
+    return output_format
+
+
+def run_shellcheck_process(shellcheck_command, cwd):
+    """run shellcheck in the outdir, with close_fds=False
+    subprocess can use vfork() instead of fork()"""
     logger.debug("Starting subprocess: %s", shellcheck_command)
     proc = subprocess.run(
         shellcheck_command,
         shell=False,
-        stdout=sys.stdout,
-        stderr=sys.stderr,
-        cwd=args.outdir,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # our own file descriptors are not inheritable anyway
+        close_fds=False,
     )
-    logger.debug("subprocess result: %s", proc)
+    logger.debug("subprocess result: %s", proc.returncode)
     return proc
 
 
+def get_max_command_length():
+    """the space for the shellcheck command line in bytes,
+    using only half of ARG_MAX leaves room for the environment"""
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        # Windows limits the whole command line to 32767 characters
+        arg_max = 32767
+    return arg_max // 2
+
+
+def split_command_arguments(shellcheck_command, filenames, max_length):
+    """split the file list into parts that fit into one command line each,
+    every argument also needs a terminating null byte and a pointer"""
+    base_length = sum(len(os.fsencode(arg)) + 9 for arg in shellcheck_command)
+    part, length = [], base_length
+    for filename in filenames:
+        arg_length = len(os.fsencode(filename)) + 9
+        if part and length + arg_length > max_length:
+            yield part
+            part, length = [], base_length
+        part.append(filename)
+        length += arg_length
+    if part:
+        yield part
+
+
+def run_shellcheck(args, filenames):
+    """run shellcheck on all files, split into chunks for parallel processes,
+    and return the highest exit code"""
+    if not filenames:
+        return 0
+    shellcheck_command = list(args.command_argv)
+    # look up the executable once, not in every child process
+    shellcheck_command[0] = shutil.which(shellcheck_command[0]) or shellcheck_command[0]
+    # shellcheck reads more options from SHELLCHECK_OPTS, before its arguments
+    shellcheck_options = os.environ.get("SHELLCHECK_OPTS", "").split() + shellcheck_command[1:]
+    # output is captured, so keep the colors shellcheck would use on a terminal
+    if sys.stdout.isatty() and not any(
+        arg.startswith(("-C", "--color")) for arg in shellcheck_options
+    ):
+        shellcheck_command.append("--color=always")
+
+    # shellcheck checks its files one after another, so we start one process per CPU
+    # (or --jobs);
+    # but only if the output of several processes can simply be concatenated,
+    # i.e. not for json or checkstyle, and not for tty or diff with their summary
+    # at the end; and with a minimum number of files per process
+    concat_output = get_output_format(shellcheck_options) in _CONCAT_FORMATS
+    if concat_output:
+        processes = (len(filenames) + _MIN_FILES_PER_PROCESS - 1) // _MIN_FILES_PER_PROCESS
+        processes = min(processes, args.jobs or os.cpu_count() or 1)
+    else:
+        processes = 1
+    chunk_size = (len(filenames) + processes - 1) // processes
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    # and every command line has to stay below the system limit
+    max_length = get_max_command_length()
+    chunks = [
+        part
+        for chunk in chunks
+        for part in split_command_arguments(shellcheck_command, chunk, max_length)
+    ]
+    if not concat_output and len(chunks) > 1:
+        logger.warning(
+            "too many files for one shellcheck command, output is split into %d parts",
+            len(chunks),
+        )
+
+    returncode = 0
+    # the file names are relative to outdir
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        procs = executor.map(
+            lambda chunk: run_shellcheck_process(shellcheck_command + chunk, args.outdir),
+            chunks,
+        )
+        # pass on the complete output of every process in order, with one write per stream
+        for proc in procs:
+            for stream, output in ((sys.stdout, proc.stdout), (sys.stderr, proc.stderr)):
+                if output:
+                    stream.flush()
+                    stream.buffer.write(output)
+                    stream.buffer.flush()
+            returncode = max(returncode, proc.returncode)
+    return returncode
+
+
 def cleanup_files(args):
     if args.keep:
         return
@@ -460,19 +831,64 @@ def cleanup_files(args):
 def main():
     args = setup()
 
-    filenames = []
-    for filename in args.files:
-        try:
-            result = {filename: read_yaml_file(filename)}
-            logger.debug("%s", result)
-            filenames.extend(write_tmp_files(args, result))
-        except ValueError as e:
-            # only log, then ignore the error
-            logger.error("%s", e)
-    check_proc_result = run_shellcheck(args, filenames)
-    cleanup_files(args)
+    # always remove the working dir, also after unexpected errors
+    try:
+        cache_dir = None if args.no_cache else get_cache_dir()
+        tool = file_fingerprint(__file__)
+        jobs = []
+        for filename in args.files:
+            fingerprint, scripts, messages = None, None, []
+            if cache_dir:
+                fingerprint, scripts, messages = get_cached_scripts(cache_dir, tool, filename)
+            if scripts is not None:
+                logger.debug("unchanged file %s, using cached scripts", filename)
+            jobs.append((filename, fingerprint, scripts, messages))
+        uncached = [filename for filename, _, scripts, _ in jobs if scripts is None]
+
+        results = {}
+        # parsing YAML is CPU-bound, so read all input files in parallel,
+        # but write the tmp files in input order to keep the output stable;
+        # starting the worker processes only pays off for more than one file,
+        # and not with --jobs 1
+        pool = contextlib.nullcontext()
+        if len(uncached) > 1 and args.jobs != 1:
+            # multiprocessing is slow to import, so only import it when it is used
+            from concurrent.futures import ProcessPoolExecutor
+
+            pool = ProcessPoolExecutor(
+                max_workers=args.jobs, initializer=setup_logging, initargs=(args.debug,)
+            )
+        with pool as executor:
+            futures = {}
+            if executor:
+                futures = {filename: executor.submit(parse_yaml_file, filename) for filename in uncached}
+            for filename, fingerprint, scripts, messages in jobs:
+                try:
+                    if scripts is None:
+                        if futures:
+                            scripts, messages = futures[filename].result()
+                        else:
+                            scripts, messages = parse_yaml_file(filename)
+                        if fingerprint:
+                            save_cached_scripts(
+                                cache_dir, tool, filename, fingerprint, scripts, messages
+                            )
+                    else:
+                        # repeat the warnings and infos from parsing the file
+                        for level, message in messages:
+                            logger.log(level, "%s", message)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("%s", {filename: scripts})
+                    results[filename] = scripts
+                except (ValueError, OSError) as e:
+                    # only log, then ignore the error, e.g. a missing or invalid file
+                    logger.error("%s", e)
+        filenames = write_tmp_files(args, results)
+        returncode = run_shellcheck(args, filenames)
+    finally:
+        cleanup_files(args)
     # exit with shellcheck exit code
-    sys.exit(check_proc_result.returncode if check_proc_result else 0)
+    sys.exit(returncode)
 
 
 if __name__ == "__main__":